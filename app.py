@@ -2,11 +2,12 @@ import os
 import gradio as gr
 
 from src.ingest import ingest_file
-from src.normalize_ar import has_diacritics, normalize_ar_for_search
+from src.normalize_ar import has_diacritics
 from src.chunking import intelligent_chunk
-from src.embeddings import embed_texts, embed_query
-from src.storage_vector import upsert_chunks, query_chunks
+from src.embeddings import embed_texts
+from src.storage_vector import upsert_chunks
 from src.storage_sql import init_db, upsert_document, upsert_chunk
+from src.rag import retrieve, hydrate_texts
 
 
 def run(file_obj, do_index, query, top_k):
@@ -48,10 +49,10 @@ def run(file_obj, do_index, query, top_k):
             for c in chunks
         ]
 
-        # Store in Vector DB (Chroma)
-        upsert_chunks(chunk_ids, vectors.tolist(), metadatas, chunk_texts)
+        # Store in Vector DB (Chroma), vectors + metadata only
+        upsert_chunks(chunk_ids, vectors.tolist(), metadatas)
 
-        # Store metadata in SQL (SQLite)
+        # Store metadata + compressed full text in SQL (SQLite)
         filetype = os.path.splitext(filename)[1].lower()
         upsert_document(doc_id=doc_id, filename=filename, filetype=filetype)
 
@@ -66,6 +67,7 @@ def run(file_obj, do_index, query, top_k):
                 has_diacritics=has_diacritics(c["text"]),
                 char_count=len(c["text"]),
                 preview=preview,
+                text=c["text"],
             )
 
         info_lines.append(f"Indexed: {filename}")
@@ -84,27 +86,22 @@ def run(file_obj, do_index, query, top_k):
 
     # Search
     if query and query.strip():
-        # Normalize Arabic for retrieval (diacritics-insensitive search)
-        q_norm = normalize_ar_for_search(query)
-        q_vec = embed_query(q_norm)
+        # Normalize Arabic + embed + top-k ids, then fetch only the shown text
+        hits = retrieve(query, top_k=int(top_k), with_text=False)
 
-        res = query_chunks(q_vec.tolist(), top_k=int(top_k))
-
-        docs = res.get("documents", [[]])[0]
-        metas = res.get("metadatas", [[]])[0]
-        dists = res.get("distances", [[]])[0]
-
-        if not docs:
+        if not hits:
             results_text = "No results returned."
         else:
-            results_text = f"Top {len(docs)} results:\n"
-            for i, (text, meta, dist) in enumerate(zip(docs, metas, dists), start=1):
+            hydrate_texts(hits, max_chars=600)
+            results_text = f"Top {len(hits)} results:\n"
+            for i, hit in enumerate(hits, start=1):
+                meta = hit["meta"]
                 results_text += (
                     f"\n[{i}] doc={meta.get('doc_id')} "
                     f"chunk={meta.get('chunk_id')} "
                     f"strategy={meta.get('strategy')} "
-                    f"dist={float(dist):.4f}\n"
-                    f"{text[:600]}\n"
+                    f"dist={hit['distance']:.4f}\n"
+                    f"{hit['text']}\n"
                     "-----------------\n"
                 )
     else:
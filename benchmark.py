@@ -1,37 +1,34 @@
 """
 Small benchmark:
 - Recall@K , basic indexing time
+- Recall loss of reduced-dimension search + full-precision rescoring
 """
 
 import os
 import time
 
+import numpy as np
+
 from src.ingest import ingest_file
 from src.chunking import intelligent_chunk
 from src.embeddings import embed_texts, embed_query
-from src.storage_vector import upsert_chunks, query_chunks
+from src.storage_vector import query_chunks
+from src.rag import index_file_to_stores
 from src.normalize_ar import normalize_ar_for_search
+from src.vector_reduce import PCA_MIN_FACTOR, FullVectorStore, fit_projection, project
 
 TEST_DOC = "sampletest.docx"
 
+# Extra documents for the reduced-dim benchmark corpus
+BENCH_DOCS_DIR = "benchmark_docs"
+
 
 def benchmark_recall_at_k(k: int = 5) -> None:
     print("Running Recall@K benchmark...")
 
-    blocks = ingest_file(TEST_DOC)
-    strategy, chunks = intelligent_chunk(blocks)
-
-    chunk_texts = [c["text"] for c in chunks]
-    vectors = embed_texts(chunk_texts)
-
-    doc_id = "benchmark_doc"
-    chunk_ids = [f"{doc_id}::chunk_{c['chunk_id']}" for c in chunks]
-    metadatas = [
-        {"doc_id": doc_id, "chunk_id": c["chunk_id"], "strategy": strategy}
-        for c in chunks
-    ]
-
-    upsert_chunks(chunk_ids, vectors.tolist(), metadatas, chunk_texts)
+    # Index like the app does (vectors + SQL rows + full text), so the
+    # test doc renders normally if it later shows up in app results
+    doc_id = index_file_to_stores(TEST_DOC)["doc_id"]
 
     test_queries = ["title","question" ,"inquiry"]
 
@@ -64,6 +61,98 @@ def benchmark_speed() -> None:
     print(f"Indexing time: {end - start:.2f} seconds")
 
 
+def _reduced_bench_corpus(min_size: int):
+    """
+    Full-precision vectors to benchmark on: the stored full vectors of the
+    reduced index if there are enough, else the chunks of TEST_DOC plus every
+    document in BENCH_DOCS_DIR.
+    """
+    store = FullVectorStore()
+    if store.count() >= min_size:
+        return store.get(store.all_ids()), "stored full vectors (.chroma_full)"
+
+    paths = [TEST_DOC]
+    if os.path.isdir(BENCH_DOCS_DIR):
+        for name in sorted(os.listdir(BENCH_DOCS_DIR)):
+            if os.path.splitext(name)[1].lower() in (".txt", ".pdf", ".docx", ".doc"):
+                paths.append(os.path.join(BENCH_DOCS_DIR, name))
+
+    chunk_texts = []
+    for path in paths:
+        _strategy, chunks = intelligent_chunk(ingest_file(path))
+        chunk_texts.extend(c["text"] for c in chunks)
+
+    return embed_texts(chunk_texts), f"{len(paths)} documents"
+
+
+def _time_per_query(fn, queries) -> tuple:
+    start = time.perf_counter()
+    out = [fn(i, q) for i, q in enumerate(queries)]
+    return out, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def benchmark_reduced_recall(k: int = 5, dim: int = 128, rescore_factor: int = 4, n_queries: int = 50) -> None:
+    """
+    Compare exact full-precision top-k against reduced-dim search (PCA and
+    truncation), with and without rescoring the top k * rescore_factor candidates.
+    Held-out corpus vectors are used as queries. Search is brute force numpy
+    in memory, so the index on disk is not touched.
+    """
+    print(f"Running reduced-dim benchmark (dim={dim})...")
+
+    n_cand = k * rescore_factor
+    min_size = max(PCA_MIN_FACTOR * dim, 10 * n_cand) + n_queries
+    vectors, source = _reduced_bench_corpus(min_size)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if len(vectors) < min_size:
+        print(
+            f"Skipped: only {len(vectors)} vectors from {source}, need {min_size} "
+            f"(index more files or put documents in {BENCH_DOCS_DIR}/)"
+        )
+        return
+
+    rng = np.random.default_rng(0)
+    order = rng.permutation(len(vectors))
+    queries = vectors[order[:n_queries]]
+    corpus = vectors[order[n_queries:]]
+    print(f"Corpus: {len(corpus)} vectors from {source}, {n_queries} held-out queries")
+
+    def full_search(_i, q):
+        scores = corpus @ q
+        top = np.argpartition(-scores, k)[:k]
+        return top[np.argsort(-scores[top])]
+
+    exact, full_ms = _time_per_query(full_search, queries)
+    print(f"Full {corpus.shape[1]} dims: {corpus.nbytes / 1e6:.1f} MB, {full_ms:.3f} ms/query")
+
+    for method in ("pca", "truncate"):
+        proj = fit_projection(corpus, dim, method=method)
+        small = project(corpus, proj)
+        q_small = project(queries, proj)
+
+        def first_stage(i, _q):
+            scores = small @ q_small[i]
+            cand = np.argpartition(-scores, n_cand)[:n_cand]
+            return cand[np.argsort(-scores[cand])]
+
+        def rescore(i, cand):
+            return cand[np.argsort(-(corpus[cand] @ queries[i]))[:k]]
+
+        cands, small_ms = _time_per_query(first_stage, queries)
+        rescored, rescore_ms = _time_per_query(rescore, cands)
+
+        total = k * n_queries
+        first_hits = sum(len(set(e) & set(c[:k])) for e, c in zip(exact, cands))
+        rescored_hits = sum(len(set(e) & set(r)) for e, r in zip(exact, rescored))
+
+        print(f"[{method}] {corpus.shape[1]} -> {proj.dim} dims: {small.nbytes / 1e6:.1f} MB "
+              f"({corpus.nbytes / small.nbytes:.1f}x smaller)")
+        print(f"[{method}] first stage {small_ms:.3f} ms/query + rescore {rescore_ms:.3f} ms/query "
+              f"({full_ms / (small_ms + rescore_ms):.1f}x vs full)")
+        print(f"[{method}] Recall@{k} vs exact, first stage only: {first_hits / total:.2f}")
+        print(f"[{method}] Recall@{k} vs exact, rescored top {n_cand}: {rescored_hits / total:.2f}")
+
+
 if __name__ == "__main__":
     if not os.path.exists(TEST_DOC):
         print(f"Test file not found: {TEST_DOC}")
@@ -71,4 +160,5 @@ if __name__ == "__main__":
     else:
         benchmark_recall_at_k(k=5)
         benchmark_speed()
+        benchmark_reduced_recall(k=5, dim=128)
 
@@ -0,0 +1,106 @@
+"""
+Small in-process caches for the query path + the index generation counter.
+
+Every write to the index bumps the generation, so cached search results
+from before the write are dropped instead of being served stale.
+The generation is the mtime of a small file next to the index, so writes
+from other processes (a second indexer, the refit / rebalance CLI) are
+seen by the app too.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, Hashable, Optional
+
+GENERATION_PATH = ".index_generation"
+
+_last_bump = 0
+_generation_lock = Lock()
+
+
+def bump_generation() -> int:
+    """Mark the index as changed (called by the vector + SQL upserts)."""
+    global _last_bump
+    with _generation_lock:
+        # strictly increasing within this process even if the clock is coarse
+        ns = max(time.time_ns(), current_generation() + 1, _last_bump + 1)
+        with open(GENERATION_PATH, "a", encoding="utf-8"):
+            pass
+        os.utime(GENERATION_PATH, ns=(ns, ns))
+        _last_bump = ns
+        return ns
+
+
+def current_generation() -> int:
+    """Current index generation (0 before the first write)."""
+    try:
+        return os.stat(GENERATION_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+class TTLCache:
+    """
+    LRU cache with a max size and a time-to-live per entry.
+    Keeps hit/miss counts for hit-rate stats.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value, or None if missing/expired."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+
+            value, expires_at = item
+            if time.monotonic() >= expires_at:
+                del self._data[key]
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            if self._data:
+                self.invalidations += 1
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
@@ -1,12 +1,27 @@
+import json
+import logging
 import os
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 from src.ingest import ingest_file
 from src.chunking import intelligent_chunk
 from src.normalize_ar import normalize_ar_for_search, has_diacritics
 from src.embeddings import embed_texts, embed_query
 from src.storage_vector import upsert_chunks, query_chunks
-from src.storage_sql import upsert_document, upsert_chunk
+from src.storage_sql import upsert_document, upsert_chunk, get_chunk_texts, get_chunk_previews
+from src.cache import TTLCache, current_generation
+
+# Query embeddings never go stale (same model), results do when the index changes
+QUERY_VEC_CACHE_SIZE = int(os.environ.get("QUERY_VEC_CACHE_SIZE", "1024"))
+QUERY_VEC_CACHE_TTL = float(os.environ.get("QUERY_VEC_CACHE_TTL", "3600"))
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "256"))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "300"))
+
+_query_vec_cache = TTLCache(maxsize=QUERY_VEC_CACHE_SIZE, ttl=QUERY_VEC_CACHE_TTL)
+_result_cache = TTLCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+_result_cache_generation = current_generation()
+
+logger = logging.getLogger(__name__)
 
 
 def index_file_to_stores(filepath: str) -> Dict[str, Any]:
@@ -37,10 +52,10 @@ def index_file_to_stores(filepath: str) -> Dict[str, Any]:
         for c in chunks
     ]
 
-    # Vector DB: text , embeddings , metadata for semantic retrieval
-    upsert_chunks(chunk_ids, vectors.tolist(), metadatas, chunk_texts)
+    # Vector DB: embeddings , metadata for semantic retrieval
+    upsert_chunks(chunk_ids, vectors.tolist(), metadatas)
 
-    # SQL DB: structured metadata which is the doc + chunk summaries
+    # SQL DB: structured metadata which is the doc + chunk summaries + compressed full text
     filetype = os.path.splitext(filename)[1].lower()
     upsert_document(doc_id=doc_id, filename=filename, filetype=filetype)
 
@@ -54,6 +69,7 @@ def index_file_to_stores(filepath: str) -> Dict[str, Any]:
             has_diacritics=has_diacritics(c["text"]),
             char_count=len(c["text"]),
             preview=c["text"][:300],
+            text=c["text"],
         )
 
     return {
@@ -65,28 +81,110 @@ def index_file_to_stores(filepath: str) -> Dict[str, Any]:
     }
 
 
-def retrieve(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
+def hydrate_texts(results: List[Dict[str, Any]], max_chars: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Fill in "text" for retrieve() results with one bulk SQL fetch.
+    max_chars cuts each text (e.g. for display).
+    Chunks indexed before full texts were stored fall back to their preview.
+    """
+    texts = get_chunk_texts([r["chunk_uid"] for r in results])
+
+    missing = [r["chunk_uid"] for r in results if r["chunk_uid"] not in texts]
+    if missing:
+        logger.warning(
+            "No stored full text for %d chunks (re-index their documents), using previews: %s",
+            len(missing), ", ".join(missing),
+        )
+        texts.update(get_chunk_previews(missing))
+
+    for r in results:
+        text = texts.get(r["chunk_uid"], "")
+        r["text"] = text[:max_chars] if max_chars is not None else text
+    return results
+
+
+def _embed_query_cached(q_norm: str) -> List[float]:
+    """Embed a normalized query, so diacritic variants share one cache entry."""
+    q_vec = _query_vec_cache.get(q_norm)
+    if q_vec is None:
+        q_vec = embed_query(q_norm).tolist()
+        _query_vec_cache.set(q_norm, q_vec)
+    return q_vec
+
+
+def _copy_results(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    # callers (hydrate_texts) fill results in place, keep the cached ones clean
+    return [{**r, "meta": dict(r["meta"])} for r in results]
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Hit-rate stats of the query caches."""
+    return {
+        "query_embeddings": _query_vec_cache.stats(),
+        "results": _result_cache.stats(),
+    }
+
+
+def clear_caches() -> None:
+    _query_vec_cache.clear()
+    _result_cache.clear()
+
+
+def retrieve(
+    query: str,
+    top_k: int = 5,
+    with_text: bool = True,
+    where: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
     """
     Semantic retrieval:
     normalize query then embed then top-k from vector DB 
+    with_text=False only returns ids, metadata and distances (use hydrate_texts later)
+    where is an optional metadata filter passed to the vector DB
+    Results are cached until the index generation changes.
     """
+    global _result_cache_generation
+
     q_norm = normalize_ar_for_search(query)
-    q_vec = embed_query(q_norm)
 
-    res = query_chunks(q_vec.tolist(), top_k=int(top_k))
+    # The generation is part of the key, so results computed before an index
+    # write are never served after it. Clearing only frees the old entries.
+    generation = current_generation()
+    if generation > _result_cache_generation:
+        _result_cache.clear()
+        _result_cache_generation = generation
+
+    key = (generation, q_norm, int(top_k), json.dumps(where, sort_keys=True))
+    cached = _result_cache.get(key)
+    if cached is not None:
+        results = _copy_results(cached)
+        if with_text:
+            hydrate_texts(results)
+        return results
+
+    q_vec = _embed_query_cached(q_norm)
 
-    docs = res.get("documents", [[]])[0]
+    res = query_chunks(q_vec, top_k=int(top_k), where=where)
+
+    ids = res.get("ids", [[]])[0]
     metas = res.get("metadatas", [[]])[0]
     dists = res.get("distances", [[]])[0]
 
     results: List[Dict[str, Any]] = []
-    for text, meta, dist in zip(docs, metas, dists):
+    for chunk_uid, meta, dist in zip(ids, metas, dists):
         results.append(
             {
-                "text": text,
+                "chunk_uid": chunk_uid,
                 "meta": meta,
                 "distance": float(dist),
             }
         )
+
+    # An upsert during the search may or may not be in these results, don't cache them
+    if current_generation() == generation:
+        _result_cache.set(key, _copy_results(results))
+
+    if with_text:
+        hydrate_texts(results)
     return results
 
@@ -1,20 +1,50 @@
-"""SQLite storage for document + chunk metadata"""
+"""SQLite storage for document + chunk metadata, and the compressed full chunk text"""
 
 import sqlite3
+import zlib
 from datetime import datetime
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
+
+from src.cache import bump_generation
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib is used without it
+    zstandard = None
 
 DB_PATH = "data.sqlite3"
 
+# Codec for new chunk texts, rows keep their own codec so both can be read back
+TEXT_CODEC = "zstd" if zstandard is not None else "zlib"
+
+# SQLite limits the number of ? parameters per statement
+_FETCH_BATCH = 500
+
+# DB files whose tables were already created in this process
+_initialized = set()
+
 
 def get_conn() -> sqlite3.Connection:
-    """Open a SQLite connection ,creates DB file if missing."""
-    return sqlite3.connect(DB_PATH)
+    """
+    Open a SQLite connection ,creates DB file if missing.
+    Tables are created on the first connection, so callers that never ran
+    init_db() (rag.retrieve, an older DB without chunk_texts) still work.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    if DB_PATH not in _initialized:
+        _create_tables(conn)
+        _initialized.add(DB_PATH)
+    return conn
 
 
 def init_db() -> None:
     """Create tables if they don't exist."""
     conn = get_conn()
+    _create_tables(conn)
+    conn.close()
+
+
+def _create_tables(conn: sqlite3.Connection) -> None:
     cur = conn.cursor()
 
     cur.execute(
@@ -44,8 +74,39 @@ def init_db() -> None:
         """
     )
 
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chunk_texts (
+            chunk_uid TEXT PRIMARY KEY,
+            codec TEXT NOT NULL,
+            body BLOB NOT NULL,
+            FOREIGN KEY (chunk_uid) REFERENCES chunks(chunk_uid)
+        )
+        """
+    )
+
     conn.commit()
-    conn.close()
+
+
+def compress_text(text: str, codec: str = TEXT_CODEC) -> bytes:
+    """Compress chunk text with zstd or zlib."""
+    raw = text.encode("utf-8")
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(raw)
+    if codec == "zlib":
+        return zlib.compress(raw, 9)
+    raise ValueError(f"Unsupported text codec: {codec}")
+
+
+def decompress_text(body: bytes, codec: str) -> str:
+    """Inverse of compress_text."""
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Chunk text is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(body).decode("utf-8")
+    if codec == "zlib":
+        return zlib.decompress(body).decode("utf-8")
+    raise ValueError(f"Unsupported text codec: {codec}")
 
 
 def upsert_document(doc_id: str, filename: str, filetype: str) -> None:
@@ -64,6 +125,8 @@ def upsert_document(doc_id: str, filename: str, filetype: str) -> None:
     conn.commit()
     conn.close()
 
+    bump_generation()
+
 
 def upsert_chunk(
     chunk_uid: str,
@@ -73,8 +136,13 @@ def upsert_chunk(
     has_diacritics: bool,
     char_count: int,
     preview: str,
+    text: Optional[str] = None,
 ) -> None:
-    """Insert or replace one chunk metadata row."""
+    """
+    Insert or replace one chunk metadata row.
+    If text is given, the full chunk text is stored compressed as well.
+    preview stays plain text so the chunks table can be read with any SQLite tool.
+    """
     conn = get_conn()
     cur = conn.cursor()
 
@@ -96,10 +164,60 @@ def upsert_chunk(
         ),
     )
 
+    if text is not None:
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO chunk_texts (chunk_uid, codec, body)
+            VALUES (?, ?, ?)
+            """,
+            (chunk_uid, TEXT_CODEC, compress_text(text)),
+        )
+
     conn.commit()
     conn.close()
 
 
+def get_chunk_texts(chunk_uids: List[str]) -> Dict[str, str]:
+    """Bulk fetch + decompress full chunk texts. Missing uids are left out."""
+    conn = get_conn()
+    cur = conn.cursor()
+
+    texts: Dict[str, str] = {}
+    uids = list(dict.fromkeys(chunk_uids))
+    for start in range(0, len(uids), _FETCH_BATCH):
+        batch = uids[start:start + _FETCH_BATCH]
+        placeholders = ",".join("?" for _ in batch)
+        cur.execute(
+            f"SELECT chunk_uid, codec, body FROM chunk_texts WHERE chunk_uid IN ({placeholders})",
+            batch,
+        )
+        for chunk_uid, codec, body in cur.fetchall():
+            texts[chunk_uid] = decompress_text(body, codec)
+
+    conn.close()
+    return texts
+
+
+def get_chunk_previews(chunk_uids: List[str]) -> Dict[str, str]:
+    """Bulk fetch the short plain-text previews. Missing uids are left out."""
+    conn = get_conn()
+    cur = conn.cursor()
+
+    previews: Dict[str, str] = {}
+    uids = list(dict.fromkeys(chunk_uids))
+    for start in range(0, len(uids), _FETCH_BATCH):
+        batch = uids[start:start + _FETCH_BATCH]
+        placeholders = ",".join("?" for _ in batch)
+        cur.execute(
+            f"SELECT chunk_uid, preview FROM chunks WHERE chunk_uid IN ({placeholders})",
+            batch,
+        )
+        previews.update(cur.fetchall())
+
+    conn.close()
+    return previews
+
+
 def list_docs(limit: int = 20) -> List[Tuple]:
     """List recent documents (small helper for debugging)."""
     conn = get_conn()
@@ -1,5 +1,15 @@
 """
 Store and search embeddings using ChromaDB (local vector database).
+
+Chunks can be split across several shards (routed by doc_id hash).
+Each shard is served by its own worker process, and queries fan out
+to all shards in parallel before the top-k results are merged.
+
+Optionally only a reduced-dimension projection of each vector is kept in
+Chroma; full vectors live in src.vector_reduce and rescore the candidates.
+
+Chroma only holds vectors and small metadata, the chunk text lives in SQLite
+(see src.storage_sql.get_chunk_texts).
 """
 
 # Disable Chroma telemetry for error i was getting
@@ -7,54 +17,565 @@ import os
 os.environ["ANONYMIZED_TELEMETRY"] = "False"
 os.environ["CHROMA_TELEMETRY"] = "False"
 
+import argparse
+import hashlib
+import heapq
+import logging
+import multiprocessing
+import random
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock, RLock
+
 import chromadb
+import numpy as np
 from chromadb.config import Settings
 
+from src.cache import bump_generation
+from src.vector_reduce import (
+    PCA_MIN_FACTOR,
+    FullVectorStore,
+    activate_projection,
+    fit_projection,
+    load_projection,
+    project,
+    save_projection,
+)
+
+logger = logging.getLogger(__name__)
+
 COLLECTION_NAME = "chunks"
+CHROMA_PATH = ".chroma"
+
+# Number of shards, 1 keeps the single in-process collection
+NUM_SHARDS = int(os.environ.get("CHROMA_SHARDS", "1"))
+
+# Dimension stored in Chroma for first-stage search, 0 stores full vectors
+REDUCED_DIM = int(os.environ.get("CHROMA_REDUCED_DIM", "0"))
+
+# How many first-stage candidates per requested result get rescored
+RESCORE_FACTOR = int(os.environ.get("CHROMA_RESCORE_FACTOR", "4"))
 
-_client = None
+_REBALANCE_BATCH = 500
 
+# PCA is fitted on at most this many stored vectors
+_FIT_SAMPLE = 20000
 
-def get_chroma_client():
+# Refit once the stored vectors grew this many times since the last fit
+REFIT_GROWTH = 2
+
+_clients = {}
+_executors = {}
+_executors_lock = Lock()
+_full_store = None
+
+# Held while reduced vectors are written or a projection is rebuilt,
+# so no upsert lands in a collection that is being replaced
+_projection_lock = RLock()
+
+
+def shard_path(shard: int, num_shards: int) -> str:
+    """Folder of one shard. A single shard uses the original .chroma folder."""
+    if num_shards <= 1:
+        return CHROMA_PATH
+    return os.path.join(f"{CHROMA_PATH}_shards", f"{num_shards}", f"shard_{shard}")
+
+
+def shard_for_doc(doc_id: str, num_shards: int) -> int:
     """
-    Create a single Chroma client instance.
+    Route a document to a shard.
+    md5 is used instead of hash() so routing is stable across processes.
     """
-    global _client
-    if _client is None:
-        _client = chromadb.PersistentClient(
-            path=".chroma",
+    digest = hashlib.md5(str(doc_id).encode("utf-8")).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+def get_chroma_client(path: str = CHROMA_PATH):
+    """
+    Create a single Chroma client instance per folder.
+    """
+    if path not in _clients:
+        _clients[path] = chromadb.PersistentClient(
+            path=path,
             settings=Settings(anonymized_telemetry=False)
         )
-        
-    return _client
 
+    return _clients[path]
+
+
+def reduced_collection_name(version: int) -> str:
+    """Each projection version gets its own collection, Chroma fixes the dim per collection."""
+    return f"{COLLECTION_NAME}_d{REDUCED_DIM}_v{version}"
 
-def get_collection():
+
+def collection_name():
+    """Collection that currently serves search (None in reduced mode before any projection)."""
+    if not REDUCED_DIM:
+        return COLLECTION_NAME
+    proj = load_projection(REDUCED_DIM)
+    return reduced_collection_name(proj.version) if proj is not None else None
+
+
+def get_collection(path: str = CHROMA_PATH, name: str = None):
     """Get or create the collection."""
-    client = get_chroma_client()
-    return client.get_or_create_collection(name=COLLECTION_NAME)
+    client = get_chroma_client(path)
+    return client.get_or_create_collection(name=name or collection_name())
+
 
+def get_full_store() -> FullVectorStore:
+    """Full-precision vectors used for rescoring in reduced mode."""
+    global _full_store
+    if _full_store is None:
+        _full_store = FullVectorStore()
+    return _full_store
 
-def upsert_chunks(chunk_ids: list[str], embeddings: list[list[float]], metadatas: list[dict], documents: list[str]):
+
+def _get_executor(shard: int) -> ProcessPoolExecutor:
     """
-    Insert or update chunk data in Chroma.
+    One single-process worker per shard, so a shard is always served by the same process.
+    Locked so two threads never start two workers on the same shard path.
+    Workers are spawned, not forked: the app process is multi-threaded
+    (gradio, torch) by the time the first shard is used.
     """
-    col = get_collection()
+    with _executors_lock:
+        if shard not in _executors:
+            _executors[shard] = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executors[shard]
+
+
+def _drop_executor(shard: int, ex: ProcessPoolExecutor) -> None:
+    """Forget a dead worker so the next call starts a fresh one."""
+    with _executors_lock:
+        if _executors.get(shard) is ex:
+            del _executors[shard]
+    ex.shutdown(wait=False)
+
+
+def _submit(shard: int, fn, args: tuple):
+    ex = _get_executor(shard)
+    try:
+        return ex, ex.submit(fn, shard_path(shard, NUM_SHARDS), *args)
+    except BrokenProcessPool:
+        _drop_executor(shard, ex)
+        ex = _get_executor(shard)
+        return ex, ex.submit(fn, shard_path(shard, NUM_SHARDS), *args)
+
+
+def _run_on_workers(fn, calls: list[tuple]) -> list:
+    """
+    Run fn(path, *args) for every (shard, args) in calls, in parallel on the shard workers.
+    A worker that died (OOM, crash) is restarted and its call retried once;
+    all shard calls are idempotent upserts / reads.
+    """
+    pending = [(shard, args, *_submit(shard, fn, args)) for shard, args in calls]
+
+    results = []
+    for shard, args, ex, fut in pending:
+        try:
+            results.append(fut.result())
+        except BrokenProcessPool:
+            logger.warning("Worker of shard %d died, restarting it", shard)
+            _drop_executor(shard, ex)
+            _ex, fut = _submit(shard, fn, args)
+            results.append(fut.result())
+    return results
+
+
+def shutdown_workers() -> None:
+    """Stop all shard worker processes."""
+    with _executors_lock:
+        for ex in _executors.values():
+            ex.shutdown(wait=True)
+        _executors.clear()
+
+
+def _on_shard(shard: int, num_shards: int, fn, *args):
+    """Run fn(path, *args) for one shard, inside its worker when that layout is the served one."""
+    path = shard_path(shard, num_shards)
+    if num_shards > 1 and num_shards == NUM_SHARDS:
+        return _run_on_workers(fn, [(shard, args)])[0]
+    return fn(path, *args)
+
+
+def _empty_result() -> dict:
+    return {"ids": [[]], "metadatas": [[]], "distances": [[]]}
+
+
+def _shard_upsert(path: str, name: str, chunk_ids, embeddings, metadatas) -> None:
+    """Runs inside the shard worker."""
+    col = get_collection(path, name)
     col.upsert(
         ids=chunk_ids,
         embeddings=embeddings,
-        metadatas=metadatas,
-        documents=documents
+        metadatas=metadatas
     )
 
 
-def query_chunks(query_embedding: list[float], top_k: int = 5):
-    """
-    Retrieve the top_k most similar chunks.
-    """
-    col = get_collection()
+def _shard_query(path: str, name: str, query_embedding, top_k: int, where: dict = None) -> dict:
+    """Runs inside the shard worker."""
+    col = get_collection(path, name)
+    count = col.count()
+    if count == 0:
+        return _empty_result()
+
     return col.query(
         query_embeddings=[query_embedding],
-        n_results=top_k,
-        include=["documents", "metadatas", "distances"]
+        n_results=min(top_k, count),
+        where=where or None,
+        include=["metadatas", "distances"]
+    )
+
+
+def _shard_get(path: str, name: str, offset: int, limit: int, include: list[str]) -> dict:
+    """Runs inside the shard worker."""
+    batch = get_collection(path, name).get(limit=limit, offset=offset, include=include)
+    if batch.get("embeddings") is not None:
+        batch["embeddings"] = [list(map(float, e)) for e in batch["embeddings"]]
+    return batch
+
+
+def _shard_count(path: str, name: str) -> int:
+    """Runs inside the shard worker."""
+    return get_collection(path, name).count()
+
+
+def _shard_drop(path: str, name: str) -> None:
+    """Runs inside the shard worker."""
+    client = get_chroma_client(path)
+    if name in [getattr(c, "name", c) for c in client.list_collections()]:
+        client.delete_collection(name)
+
+
+def _merge_results(results: list[dict], top_k: int) -> dict:
+    """Merge per-shard results into one Chroma-style result by smallest distance."""
+    rows = []
+    for res in results:
+        ids = res.get("ids", [[]])[0]
+        metas = res.get("metadatas", [[]])[0]
+        dists = res.get("distances", [[]])[0]
+        rows.extend(zip(dists, ids, metas))
+
+    best = heapq.nsmallest(top_k, rows, key=lambda r: r[0])
+
+    return {
+        "ids": [[r[1] for r in best]],
+        "metadatas": [[r[2] for r in best]],
+        "distances": [[r[0] for r in best]],
+    }
+
+
+def _upsert_layout(name: str, chunk_ids, embeddings, metadatas) -> None:
+    """Write into collection name of the served layout, each chunk to the shard of its doc_id."""
+    if NUM_SHARDS <= 1:
+        _shard_upsert(CHROMA_PATH, name, chunk_ids, embeddings, metadatas)
+        return
+
+    groups = {}
+    for i, meta in enumerate(metadatas):
+        shard = shard_for_doc(meta["doc_id"], NUM_SHARDS)
+        groups.setdefault(shard, []).append(i)
+
+    calls = [
+        (
+            shard,
+            (
+                name,
+                [chunk_ids[i] for i in idx],
+                [embeddings[i] for i in idx],
+                [metadatas[i] for i in idx],
+            ),
+        )
+        for shard, idx in groups.items()
+    ]
+    _run_on_workers(_shard_upsert, calls)
+
+
+def _rescore(query_embedding, res: dict, top_k: int) -> dict:
+    """Re-rank first-stage candidates by squared L2 distance on the full vectors."""
+    ids = res.get("ids", [[]])[0]
+    metas = res.get("metadatas", [[]])[0]
+
+    # A candidate without a full vector (e.g. half-written) is dropped instead of failing the query
+    known = set(get_full_store().known(ids))
+    keep = [i for i, chunk_id in enumerate(ids) if chunk_id in known]
+    if len(keep) < len(ids):
+        logger.warning("Skipping %d candidates without a stored full vector", len(ids) - len(keep))
+    if not keep:
+        return _empty_result()
+
+    full = get_full_store().get([ids[i] for i in keep])
+    q = np.asarray(query_embedding, dtype=np.float32)
+    dists = ((full - q) ** 2).sum(axis=1)
+    order = np.argsort(dists)[:top_k]
+
+    return {
+        "ids": [[ids[keep[i]] for i in order]],
+        "metadatas": [[metas[keep[i]] for i in order]],
+        "distances": [[float(dists[i]) for i in order]],
+    }
+
+
+def _needs_refit(proj, count: int) -> bool:
+    if proj.method == "truncate":
+        return count >= PCA_MIN_FACTOR * REDUCED_DIM
+    return count >= REFIT_GROWTH * max(proj.n_vectors, 1)
+
+
+def _upsert_reduced(chunk_ids, embeddings, metadatas) -> None:
+    """
+    Keep the full vectors on disk and write the projected ones to the active version.
+    The first upsert fits projection v1 (a truncation until PCA_MIN_FACTOR * REDUCED_DIM
+    vectors exist). After that a refit runs automatically when PCA becomes possible
+    and whenever the store has grown REFIT_GROWTH times since the last fit.
+
+    The refit re-projects the whole index synchronously inside this upsert,
+    holding _projection_lock, so the upsert that triggers it (and any other
+    upsert meanwhile) waits for it. Queries are not blocked. Growth-based
+    refits keep the total re-projection work linear in the corpus size.
+    """
+    full = np.asarray(embeddings, dtype=np.float32)
+    if full.shape[1] < REDUCED_DIM:
+        raise ValueError(f"CHROMA_REDUCED_DIM={REDUCED_DIM} is larger than the embedding dim {full.shape[1]}")
+
+    store = get_full_store()
+    with _projection_lock:
+        store.put(chunk_ids, full)
+
+        proj = load_projection(REDUCED_DIM)
+        if proj is None:
+            refit_projection()
+            proj = load_projection(REDUCED_DIM)
+
+        _upsert_layout(reduced_collection_name(proj.version), chunk_ids, project(full, proj).tolist(), metadatas)
+
+        count = store.count()
+        if _needs_refit(proj, count):
+            logger.info(
+                "%d vectors stored, %s projection v%d was fitted at %d, refitting",
+                count, proj.method, proj.version, proj.n_vectors,
+            )
+            refit_projection()
+
+
+def upsert_chunks(chunk_ids: list[str], embeddings: list[list[float]], metadatas: list[dict]):
+    """
+    Insert or update chunk data in Chroma.
+    With several shards, each chunk goes to the shard of its doc_id.
+    Bumps the index generation so cached query results are dropped.
+    """
+    if REDUCED_DIM:
+        _upsert_reduced(chunk_ids, embeddings, metadatas)
+    else:
+        _upsert_layout(COLLECTION_NAME, chunk_ids, embeddings, metadatas)
+
+    bump_generation()
+
+
+def _search(name: str, query_embedding: list[float], top_k: int, where: dict = None) -> dict:
+    if NUM_SHARDS <= 1:
+        return _shard_query(CHROMA_PATH, name, query_embedding, top_k, where)
+
+    calls = [(shard, (name, query_embedding, top_k, where)) for shard in range(NUM_SHARDS)]
+    return _merge_results(_run_on_workers(_shard_query, calls), top_k)
+
+
+def query_chunks(query_embedding: list[float], top_k: int = 5, where: dict = None):
+    """
+    Retrieve the top_k most similar chunks (ids, metadatas, distances).
+    where is an optional Chroma metadata filter, e.g. {"doc_id": "a.pdf"}.
+    With several shards, every shard is searched in parallel and the results merged.
+    In reduced mode, top_k * RESCORE_FACTOR candidates are rescored with full vectors.
+    """
+    if not REDUCED_DIM:
+        return _search(COLLECTION_NAME, query_embedding, top_k, where)
+
+    proj = load_projection(REDUCED_DIM)
+    if proj is None:
+        logger.warning(
+            "No active d%d projection, run 'python -m src.storage_vector refit' "
+            "to build the reduced index from the existing one",
+            REDUCED_DIM,
+        )
+        return _empty_result()
+
+    q_small = project(query_embedding, proj)[0].tolist()
+    res = _search(reduced_collection_name(proj.version), q_small, top_k * RESCORE_FACTOR, where)
+    return _rescore(query_embedding, res, top_k)
+
+
+def iter_chunks(num_shards: int, name: str, include: list[str]):
+    """Yield every chunk of collection name in batches (Chroma get() results) across all shards."""
+    for shard in range(num_shards):
+        offset = 0
+        while True:
+            batch = _on_shard(shard, num_shards, _shard_get, name, offset, _REBALANCE_BATCH, include)
+            if not batch["ids"]:
+                break
+            yield batch
+            offset += len(batch["ids"])
+
+
+def rebalance(from_shards: int, to_shards: int, overwrite: bool = False) -> int:
+    """
+    Copy every chunk from the from_shards layout into the to_shards layout,
+    re-routing by doc_id. The old layout is left untouched.
+    Both the full-dim collection and, in reduced mode, the active reduced
+    collection are moved, so the new layout still works with either setting.
+    A non-empty destination is refused unless overwrite=True, which clears it first
+    (otherwise chunks of removed / re-chunked documents would linger there).
+    The app must be stopped first, Chroma does not support two processes on one path.
+    Returns the number of vectors moved (summed over the collections).
+    """
+    if from_shards < 1 or to_shards < 1:
+        raise ValueError("Shard counts must be >= 1")
+    if from_shards == to_shards:
+        return 0
+
+    names = [COLLECTION_NAME]
+    if REDUCED_DIM and collection_name() is not None:
+        names.append(collection_name())
+
+    for name in names:
+        for dst in range(to_shards):
+            if _on_shard(dst, to_shards, _shard_count, name) == 0:
+                continue
+            if not overwrite:
+                raise ValueError(
+                    f"Destination layout with {to_shards} shards is not empty, use overwrite to clear it"
+                )
+            _on_shard(dst, to_shards, _shard_drop, name)
+
+    moved = 0
+    for name in names:
+        moved += _copy_collection(name, from_shards, to_shards)
+
+    return moved
+
+
+def _copy_collection(name: str, from_shards: int, to_shards: int) -> int:
+    moved = 0
+    for batch in iter_chunks(from_shards, name, ["embeddings", "metadatas"]):
+        ids = batch["ids"]
+
+        groups = {}
+        for i, meta in enumerate(batch["metadatas"]):
+            groups.setdefault(shard_for_doc(meta["doc_id"], to_shards), []).append(i)
+
+        for dst, idx in groups.items():
+            _on_shard(
+                dst,
+                to_shards,
+                _shard_upsert,
+                name,
+                [ids[i] for i in idx],
+                [batch["embeddings"][i] for i in idx],
+                [batch["metadatas"][i] for i in idx],
+            )
+
+        moved += len(ids)
+
+    return moved
+
+
+def refit_projection() -> int:
+    """
+    Fit a new projection version on the stored full vectors and build its
+    collection next to the active one. Search switches over only once the
+    new collection is complete, then older versions are dropped.
+
+    Chunks that only exist in the full-dim collection (an index built before
+    CHROMA_REDUCED_DIM was set) are imported, so this also builds the first
+    reduced index for an existing corpus.
+    Returns the new projection version.
+    """
+    if not REDUCED_DIM:
+        raise ValueError("Set CHROMA_REDUCED_DIM to fit a projection")
+
+    store = get_full_store()
+    with _projection_lock:
+        for batch in iter_chunks(NUM_SHARDS, COLLECTION_NAME, ["embeddings"]):
+            # Never overwrite a full vector written in reduced mode with an older one
+            known = set(store.known(batch["ids"]))
+            new = [i for i, chunk_id in enumerate(batch["ids"]) if chunk_id not in known]
+            if new:
+                store.put(
+                    [batch["ids"][i] for i in new],
+                    np.asarray([batch["embeddings"][i] for i in new], dtype=np.float32),
+                )
+
+        ids = store.all_ids()
+        if not ids:
+            raise ValueError("No vectors stored yet, index some files first")
+        n_vectors = len(ids)
+        if n_vectors > _FIT_SAMPLE:
+            ids = random.sample(ids, _FIT_SAMPLE)
+
+        old = load_projection(REDUCED_DIM)
+        proj = fit_projection(store.get(ids), REDUCED_DIM)
+        proj.n_vectors = n_vectors
+        proj = save_projection(proj)
+        new_name = reduced_collection_name(proj.version)
+
+        # Full-dim first, so the metadata of the current reduced index wins
+        sources = [COLLECTION_NAME]
+        if old is not None:
+            sources.append(reduced_collection_name(old.version))
+
+        for source in sources:
+            for batch in iter_chunks(NUM_SHARDS, source, ["metadatas"]):
+                chunk_ids = store.known(batch["ids"])
+                if not chunk_ids:
+                    continue
+                metas = dict(zip(batch["ids"], batch["metadatas"]))
+                _upsert_layout(
+                    new_name,
+                    chunk_ids,
+                    project(store.get(chunk_ids), proj).tolist(),
+                    [metas[i] for i in chunk_ids],
+                )
+
+        activate_projection(proj)
+
+        # Keep the previous version for queries that already loaded it
+        if old is not None:
+            for version in range(1, old.version):
+                for shard in range(NUM_SHARDS):
+                    _on_shard(shard, NUM_SHARDS, _shard_drop, reduced_collection_name(version))
+
+    bump_generation()
+    return proj.version
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vector index shard tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_reb = sub.add_parser(
+        "rebalance",
+        help="Re-route all chunks into a new shard count (stop the app first, "
+             "its shard workers keep the shard folders open)",
+    )
+    p_reb.add_argument("--from", dest="from_shards", type=int, default=NUM_SHARDS)
+    p_reb.add_argument("--to", dest="to_shards", type=int, required=True)
+    p_reb.add_argument("--overwrite", action="store_true", help="Clear a non-empty destination layout first")
+
+    sub.add_parser(
+        "refit",
+        help="Fit a new projection version from all stored vectors (also builds the reduced "
+             "index from an existing full-dim one) and switch to it. Stop the app first.",
     )
+
+    args = parser.parse_args()
+    if args.cmd == "rebalance":
+        if args.from_shards < 1 or args.to_shards < 1:
+            parser.error("--from and --to must be >= 1")
+        n = rebalance(args.from_shards, args.to_shards, overwrite=args.overwrite)
+        print(f"Moved {n} vectors from {args.from_shards} to {args.to_shards} shards.")
+        print(f"Set CHROMA_SHARDS={args.to_shards} to serve the new layout.")
+    elif args.cmd == "refit":
+        logging.basicConfig(level=logging.INFO)
+        version = refit_projection()
+        print(f"Projection d{REDUCED_DIM} refitted, now at version {version}.")
@@ -0,0 +1,288 @@
+"""
+Reduced-dimension vectors for first-stage search.
+
+Full embeddings are kept on disk (memory-mapped) and are only read back
+to rescore the top candidates. The low-dimensional projection (PCA, or
+plain truncation while there are too few vectors to fit PCA) is fitted
+at index time and saved with a version number. A saved version is only
+used for search once it is activated.
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock
+from typing import List, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+PROJECTION_DIR = ".chroma_projection"
+FULL_VECTORS_DIR = ".chroma_full"
+
+# PCA is only fitted on at least this many times dim vectors, with exactly
+# dim samples the last components are noise (centered rank <= dim - 1)
+PCA_MIN_FACTOR = 4
+
+_VERSION_RE = re.compile(r"projection_d(\d+)_v(\d+)\.npz$")
+
+# dim -> (mtime of the active pointer file, Projection)
+_projections = {}
+
+
+@dataclass
+class Projection:
+    version: int
+    # "pca" or "truncate"
+    method: str
+    mean: np.ndarray
+    # shape (dim, full_dim)
+    components: np.ndarray
+    # how many vectors were stored when this was fitted (drives refit on growth)
+    n_vectors: int = 0
+
+    @property
+    def dim(self) -> int:
+        return int(self.components.shape[0])
+
+
+def fit_projection(vectors: np.ndarray, dim: int, version: int = 0, method: Optional[str] = None) -> Projection:
+    """
+    Fit a projection down to dim dimensions.
+    By default PCA is used once there are PCA_MIN_FACTOR * dim vectors,
+    before that the first dim coordinates are kept. method forces "pca" or "truncate".
+    """
+    x = np.asarray(vectors, dtype=np.float32)
+    n, full_dim = x.shape
+    if dim > full_dim:
+        raise ValueError(f"Reduced dim {dim} is larger than the embedding dim {full_dim}")
+
+    auto = method is None
+    if auto:
+        method = "pca" if n >= PCA_MIN_FACTOR * dim else "truncate"
+
+    if method == "pca":
+        mean = x.mean(axis=0)
+        _u, _s, vt = np.linalg.svd(x - mean, full_matrices=False)
+        logger.info("Fitted PCA projection %d -> %d on %d vectors", full_dim, dim, n)
+        return Projection(version, "pca", mean, vt[:dim].astype(np.float32), n)
+
+    if method != "truncate":
+        raise ValueError(f"Unknown projection method: {method}")
+
+    # e5 is not Matryoshka-trained, so this loses much more than PCA would
+    if auto:
+        logger.warning(
+            "Using truncation to the first %d dims (%d vectors, PCA needs %d)",
+            dim, n, PCA_MIN_FACTOR * dim,
+        )
+    mean = np.zeros(full_dim, dtype=np.float32)
+    components = np.eye(full_dim, dtype=np.float32)[:dim]
+    return Projection(version, "truncate", mean, components, n)
+
+
+def project(vectors: np.ndarray, proj: Projection) -> np.ndarray:
+    """Project vectors and re-normalize them so L2 distance still tracks cosine."""
+    x = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    y = (x - proj.mean) @ proj.components.T
+    norms = np.linalg.norm(y, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return y / norms
+
+
+def _projection_files(dim: int) -> List[tuple]:
+    files = []
+    for path in glob.glob(os.path.join(PROJECTION_DIR, f"projection_d{dim}_v*.npz")):
+        m = _VERSION_RE.search(path)
+        if m:
+            files.append((int(m.group(2)), path))
+    return sorted(files)
+
+
+def _projection_path(dim: int, version: int) -> str:
+    return os.path.join(PROJECTION_DIR, f"projection_d{dim}_v{version}.npz")
+
+
+def _active_path(dim: int) -> str:
+    return os.path.join(PROJECTION_DIR, f"active_d{dim}.json")
+
+
+def save_projection(proj: Projection) -> Projection:
+    """Save the projection as the next version for its dim (not active yet)."""
+    os.makedirs(PROJECTION_DIR, exist_ok=True)
+    files = _projection_files(proj.dim)
+    proj.version = files[-1][0] + 1 if files else 1
+
+    np.savez(
+        _projection_path(proj.dim, proj.version),
+        method=proj.method,
+        mean=proj.mean,
+        components=proj.components,
+        n_vectors=proj.n_vectors,
+    )
+    return proj
+
+
+def activate_projection(proj: Projection) -> None:
+    """Switch search over to this saved version."""
+    path = _active_path(proj.dim)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"version": proj.version, "method": proj.method}, f)
+    os.replace(tmp, path)
+    logger.info("Activated %s projection d%d v%d", proj.method, proj.dim, proj.version)
+
+
+def load_projection(dim: int) -> Optional[Projection]:
+    """Load the active projection version for dim (None if none is active yet)."""
+    path = _active_path(dim)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    cached = _projections.get(dim)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, "r", encoding="utf-8") as f:
+        version = json.load(f)["version"]
+
+    data = np.load(_projection_path(dim, version))
+    n_vectors = int(data["n_vectors"]) if "n_vectors" in data.files else 0
+    proj = Projection(version, str(data["method"]), data["mean"], data["components"], n_vectors)
+    _projections[dim] = (mtime, proj)
+    return proj
+
+
+@contextmanager
+def _file_lock(path: str):
+    """Exclusive lock across processes (several processes may index at once)."""
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FullVectorStore:
+    """
+    Full-precision vectors in one float32 file, one row per chunk id.
+    ids.log maps chunk id to row and is append-only, so a write costs O(batch).
+    Rows appended by other processes are picked up on the next call.
+    """
+
+    def __init__(self, folder: str = FULL_VECTORS_DIR):
+        self.folder = folder
+        self.data_path = os.path.join(folder, "vectors.f32")
+        self.log_path = os.path.join(folder, "ids.log")
+        self.meta_path = os.path.join(folder, "meta.json")
+        self.lock_path = os.path.join(folder, ".lock")
+        self._rows = {}
+        self._log_pos = 0
+        self._dim = None
+        self._mm = None
+        self._lock = Lock()
+
+    def _refresh(self) -> None:
+        """Read rows appended to ids.log since the last call."""
+        if self._dim is None and os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self._dim = json.load(f)["dim"]
+
+        if not os.path.exists(self.log_path):
+            return
+
+        with open(self.log_path, "rb") as f:
+            f.seek(self._log_pos)
+            data = f.read()
+
+        # Only consume complete lines, a writer may be mid-append
+        end = data.rfind(b"\n")
+        if end < 0:
+            return
+        for line in data[:end].splitlines():
+            chunk_id, row = json.loads(line)
+            self._rows[chunk_id] = row
+        self._log_pos += end + 1
+
+    def put(self, ids: List[str], vectors: np.ndarray) -> None:
+        """Write (or overwrite) the full vectors for these chunk ids."""
+        x = np.asarray(vectors, dtype=np.float32)
+        os.makedirs(self.folder, exist_ok=True)
+
+        with self._lock, _file_lock(self.lock_path):
+            self._refresh()
+            if self._dim is None:
+                self._dim = int(x.shape[1])
+                with open(self.meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self._dim}, f)
+            elif self._dim != x.shape[1]:
+                raise ValueError(f"Vector dim {x.shape[1]} does not match stored dim {self._dim}")
+
+            row_bytes = self._dim * 4
+            new_lines = []
+            mode = "r+b" if os.path.exists(self.data_path) else "w+b"
+            with open(self.data_path, mode) as f:
+                for chunk_id, vec in zip(ids, x):
+                    row = self._rows.get(chunk_id)
+                    if row is None:
+                        row = len(self._rows)
+                        self._rows[chunk_id] = row
+                        new_lines.append(json.dumps([chunk_id, row], ensure_ascii=False))
+                    f.seek(row * row_bytes)
+                    f.write(vec.tobytes())
+
+            # Vectors are on disk before their ids become visible to readers
+            if new_lines:
+                with open(self.log_path, "ab") as f:
+                    f.write(("\n".join(new_lines) + "\n").encode("utf-8"))
+                    self._log_pos = f.tell()
+
+            self._mm = None
+
+    def get(self, ids: List[str]) -> np.ndarray:
+        """Read the full vectors for these chunk ids from the memory map."""
+        with self._lock:
+            self._refresh()
+            n = len(self._rows)
+            if self._mm is None or self._mm.shape[0] != n:
+                self._mm = np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(n, self._dim))
+            rows = [self._rows[i] for i in ids]
+            return np.asarray(self._mm[rows])
+
+    def known(self, ids: List[str]) -> List[str]:
+        """The ids that have a stored full vector."""
+        with self._lock:
+            self._refresh()
+            return [i for i in ids if i in self._rows]
+
+    def all_ids(self) -> List[str]:
+        with self._lock:
+            self._refresh()
+            return list(self._rows.keys())
+
+    def count(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._rows)